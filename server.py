@@ -2,17 +2,20 @@ from gevent import monkey
 monkey.patch_all()
 
 import os
+import math
 import uuid
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory
+import time
+import threading
+from collections import Counter, OrderedDict
+from functools import wraps
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, session, get_template_attribute
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from datetime import datetime
+from datetime import datetime, timezone
 from sqlalchemy import or_, func
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_migrate import Migrate
-from openai import OpenAI
-import google.generativeai as genai
+from markupsafe import Markup
 
 # --- APP SETUP ---
 app = Flask(__name__)
@@ -27,8 +30,15 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 }
 
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-socketio = SocketIO(app)
+# Flask-Migrate (alembic) нужен только командам `flask db ...`, воркеры его не импортируют
+if os.environ.get('FLASK_RUN_FROM_CLI'):
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db)
+# Сериализатор Socket.IO: 'msgpack' включает компактный бинарный протокол (по умолчанию JSON)
+SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'default')
+if SOCKETIO_SERIALIZER not in ('default', 'msgpack'):
+    raise RuntimeError(f"SOCKETIO_SERIALIZER must be 'default' or 'msgpack', got {SOCKETIO_SERIALIZER!r}")
+socketio = SocketIO(app, serializer=SOCKETIO_SERIALIZER)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -52,13 +62,15 @@ class User(UserMixin, db.Model):
 class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
+    # Мягкое удаление: группа скрыта сразу, сообщения удаляются фоновой задачей
+    deleted_at = db.Column(db.DateTime, nullable=True)
     messages = db.relationship('Message', backref='group', lazy=True)
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
-    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True, index=True)
     body = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     is_read = db.Column(db.Boolean, default=False, nullable=False, server_default='false')
@@ -70,12 +82,324 @@ class Message(db.Model):
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
+def get_active_group(group_id):
+    group = db.session.get(Group, group_id)
+    if not group or group.deleted_at is not None:
+        return None
+    return group
+
+def active_groups(user):
+    return [group for group in user.groups if group.deleted_at is None]
+
+# --- GROUP PURGE ---
+GROUP_PURGE_BATCH_SIZE = int(os.environ.get('GROUP_PURGE_BATCH_SIZE', 1000))
+# Сколько последних удалений хранить в сессии для /group/<id>/delete_status
+MAX_TRACKED_PURGES = 10
+
+def remove_upload(audio_url):
+    filepath = os.path.join(app.static_folder, 'uploads', os.path.basename(audio_url))
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+def purge_group(group_id):
+    # Удаляет сообщения мягко удаленной группы пачками, каждая пачка в своей короткой транзакции
+    with app.app_context():
+        deleted = 0
+        while True:
+            batch = db.session.query(Message.id, Message.audio_url).filter(
+                Message.group_id == group_id
+            ).limit(GROUP_PURGE_BATCH_SIZE).all()
+            if not batch:
+                break
+            Message.query.filter(Message.id.in_([msg_id for msg_id, _ in batch])).delete(synchronize_session=False)
+            db.session.commit()
+            for _, audio_url in batch:
+                if audio_url:
+                    remove_upload(audio_url)
+            deleted += len(batch)
+            print(f"Group {group_id} purge: {deleted} messages deleted")
+            socketio.sleep(0)
+        group = db.session.get(Group, group_id)
+        if group:
+            db.session.delete(group)
+            db.session.commit()
+        print(f"Group {group_id} purge finished: {deleted} messages deleted")
+
+@app.cli.command('purge-deleted-groups')
+def purge_deleted_groups():
+    """Дочищает группы, фоновое удаление которых было прервано."""
+    for (group_id,) in db.session.query(Group.id).filter(Group.deleted_at.isnot(None)).all():
+        purge_group(group_id)
+
+# --- RATE LIMITING ---
+# Token bucket на сокет-соединение и на пользователя: событие -> ((емкость, токенов/сек) соединения, (емкость, токенов/сек) пользователя).
+# Переопределяется переменной окружения, например RATE_LIMIT_GROUP_MESSAGE="10/2,20/4"
+DEFAULT_RATE_LIMITS = {
+    'private_message': ((10, 2), (20, 4)),
+    'group_message': ((10, 2), (20, 4)),
+    'send_audio': ((3, 0.2), (5, 0.3)),
+    'edit_with_ai': ((3, 0.1), (5, 0.2)),
+    'chat_with_assistant': ((3, 0.1), (5, 0.2)),
+}
+
+def parse_rate_limit(name, value):
+    # Формат: "емкость/скорость,емкость/скорость" (соединение, пользователь)
+    buckets = value.split(',')
+    if len(buckets) != 2 or any(bucket.count('/') != 1 for bucket in buckets):
+        raise RuntimeError(f"{name} must look like 'burst/rate,burst/rate', got {value!r}")
+    try:
+        limits = tuple(tuple(float(part) for part in bucket.split('/')) for bucket in buckets)
+    except ValueError:
+        raise RuntimeError(f"{name} must contain numbers, got {value!r}")
+    for capacity, rate in limits:
+        if not (math.isfinite(capacity) and math.isfinite(rate)) or capacity < 1 or rate <= 0:
+            raise RuntimeError(f"{name} needs burst >= 1 and rate > 0, got {value!r}")
+    return limits
+
+RATE_LIMITS = {
+    event: parse_rate_limit(f'RATE_LIMIT_{event.upper()}', os.environ[f'RATE_LIMIT_{event.upper()}'])
+    if f'RATE_LIMIT_{event.upper()}' in os.environ else limits
+    for event, limits in DEFAULT_RATE_LIMITS.items()
+}
+
+class MemoryStore:
+    """Общее состояние (корзины лимитов, счетчики, версии данных) в памяти процесса: локальная замена Redis для одного воркера."""
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        # key -> (токены, время обновления, момент полного пополнения)
+        self.buckets = {}
+        self.counters = Counter()
+        self.versions = Counter()
+        self.lock = threading.Lock()
+        self.next_sweep = 0
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            if now >= self.next_sweep:
+                self.sweep(now)
+            tokens, updated, _ = self.buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            return allowed
+
+    def sweep(self, now):
+        # Полностью пополнившиеся корзины ничем не отличаются от новых, их можно удалить (аналог TTL в Redis)
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+        self.next_sweep = now + self.SWEEP_INTERVAL
+
+    def forget(self, key):
+        self.buckets.pop(key, None)
+
+    def incr(self, counter):
+        self.counters[counter] += 1
+
+    def get_counters(self):
+        return dict(self.counters)
+
+    def get_version(self, name):
+        return self.versions[name]
+
+    def bump_version(self, name):
+        self.versions[name] += 1
+
+class RedisStore:
+    """Общее для всех воркеров состояние; пополнение и списание токенов выполняются атомарно в Lua."""
+
+    TAKE_SCRIPT = """
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return allowed
+    """
+    COUNTERS_KEY = 'rl:counters'
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.take_script = self.client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key, capacity, rate, now):
+        return bool(self.take_script(keys=[key], args=[capacity, rate, repr(now)]))
+
+    def forget(self, key):
+        # Корзины в Redis удаляются сами по истечении TTL
+        pass
+
+    def incr(self, counter):
+        self.client.hincrby(self.COUNTERS_KEY, counter, 1)
+
+    def get_counters(self):
+        return {k.decode(): int(v) for k, v in self.client.hgetall(self.COUNTERS_KEY).items()}
+
+    def get_version(self, name):
+        return int(self.client.get(f'ver:{name}') or 0)
+
+    def bump_version(self, name):
+        self.client.incr(f'ver:{name}')
+
+# RATE_LIMIT_STORAGE_URL - прежнее имя переменной, читается для совместимости
+SHARED_STORAGE_URL = os.environ.get('SHARED_STORAGE_URL') or os.environ.get('RATE_LIMIT_STORAGE_URL', 'memory://')
+shared_store = MemoryStore() if SHARED_STORAGE_URL.startswith('memory://') else RedisStore(SHARED_STORAGE_URL)
+
+def check_rate_limit(event):
+    # Используется только id из сессии, без загрузки пользователя из БД.
+    # Анонимные запросы не тратят токены: их отклонит login_required.
+    user_id = session.get('_user_id')
+    if user_id is None:
+        return True
+    (conn_capacity, conn_rate), (user_capacity, user_rate) = RATE_LIMITS[event]
+    sid = getattr(request, 'sid', None)
+    now = time.time()
+    allowed = True
+    # Корзина соединения есть только у сокетов; у HTTP-маршрутов ее заменяет корзина пользователя
+    if sid:
+        allowed = shared_store.take(f'rl:{event}:c:{sid}', conn_capacity, conn_rate, now)
+    if allowed:
+        allowed = shared_store.take(f'rl:{event}:u:{user_id}', user_capacity, user_rate, now)
+    shared_store.incr(f'{event}:{"allowed" if allowed else "rejected"}')
+    return allowed
+
+def rate_limited(event):
+    """Отбрасывает лишние события до любой работы с БД. Ставится над login_required."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if check_rate_limit(event):
+                return f(*args, **kwargs)
+            if getattr(request, 'sid', None):
+                emit('rate_limited', {'e': event})
+                return None
+            return jsonify({"error": "Too many requests"}), 429
+        return wrapper
+    return decorator
+
+# --- FRAGMENT CACHE ---
+# Отрендеренные куски шаблонов (справочник пользователей) общие для всех пользователей.
+# Ключ включает версию данных, которая растет при регистрации, создании группы и смене состава.
+FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+def fragment_size(value):
+    # Приблизительный размер: суммарная длина строк внутри значения
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(fragment_size(k) + fragment_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(fragment_size(item) for item in value)
+    return 8
+
+class FragmentCache:
+    """LRU-кэш фрагментов, ограниченный суммарным размером. При смене версии данных старые записи удаляются целиком."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get_or_render(self, version, key, render):
+        with self.lock:
+            if self.version is None or version > self.version:
+                self.entries.clear()
+                self.total_bytes = 0
+                self.version = version
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+        value = render()
+        size = fragment_size(value)
+        with self.lock:
+            # Запрос со старой версией или фрагмент больше всего кэша не сохраняем
+            if version != self.version or size > self.max_bytes:
+                return value
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+        return value
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_MAX_BYTES)
+
+def bump_data_version():
+    shared_store.bump_version('directory')
+
+def cached_fragment(name, render, *key):
+    return fragment_cache.get_or_render(shared_store.get_version('directory'), (name,) + key, render)
+
+def render_user_items(macro_name, users, **kwargs):
+    # Каждый элемент рендерится отдельно, чтобы при выдаче можно было пропустить текущего пользователя
+    macro = get_template_attribute('fragments.html', macro_name)
+    return [(user.id, str(macro(user, **kwargs))) for user in users]
+
+def join_items(items, skip_user_id=None, only_ids=None):
+    return Markup(''.join(html for user_id, html in items
+                          if user_id != skip_user_id and (only_ids is None or user_id in only_ids)))
+
+def build_directory():
+    users = User.query.all()
+    return {
+        'user_names': {user.id: user.username for user in users},
+        'contacts': render_user_items('contact_item', users),
+        'member_items': render_user_items('member_item', users),
+        # Оба варианта чекбокса, чтобы страницы групп собирались из общего справочника
+        'member_options': render_user_items('member_option', users),
+        'member_options_checked': render_user_items('member_option', users, checked=True),
+    }
+
+def member_options_html(directory, skip_user_id, checked_ids):
+    return Markup(''.join(
+        checked_html if user_id in checked_ids else html
+        for (user_id, html), (_, checked_html) in zip(directory['member_options'], directory['member_options_checked'])
+        if user_id != skip_user_id
+    ))
+
+# --- SOCKET PAYLOADS ---
+def to_epoch_ms(dt):
+    return int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def compact_message(msg):
+    # Компактная схема для сокетов: короткие ключи, числовые id вместо имен, время в мс.
+    # s - отправитель, r - получатель, g - группа, m - текст, t - время, a - аудио, x - транскрипция
+    payload = {'s': msg.sender_id, 't': to_epoch_ms(msg.timestamp)}
+    if msg.recipient_id is not None:
+        payload['r'] = msg.recipient_id
+    if msg.group_id is not None:
+        payload['g'] = msg.group_id
+    if msg.body is not None:
+        payload['m'] = msg.body
+    if msg.audio_url is not None:
+        payload['a'] = msg.audio_url
+        payload['x'] = msg.transcription
+    return payload
+
 # --- ROUTES ---
 @app.route('/')
 @login_required
 def index():
-    users = User.query.all()
-    groups = current_user.groups
+    directory = cached_fragment('directory', build_directory)
+    groups = active_groups(current_user)
     unread_counts = {}
 
     # Оптимизация производительности: один запрос для всех личных сообщений
@@ -86,8 +410,8 @@ def index():
         Message.is_read == False
     ).group_by(Message.sender_id).all()
     
-    # Создаем словарь {sender_id: username} для быстрого доступа
-    user_map = {user.id: user.username for user in users}
+    # Словарь {sender_id: username} берется из кэша справочника
+    user_map = directory['user_names']
     for sender_id, count in private_unread:
         sender_username = user_map.get(sender_id)
         if sender_username:
@@ -107,7 +431,10 @@ def index():
         for group_id, count in group_unread:
             unread_counts[f'group_{group_id}'] = count
 
-    return render_template('index.html', current_user=current_user, users=users, groups=groups, unread_counts=unread_counts)
+    return render_template('index.html', current_user=current_user, groups=groups, unread_counts=unread_counts,
+                           contact_items=join_items(directory['contacts'], current_user.id),
+                           member_options=member_options_html(directory, current_user.id, ()),
+                           user_names=user_map, socketio_serializer=SOCKETIO_SERIALIZER)
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -121,6 +448,9 @@ def register():
         new_user = User(username=username, password=hashed_password)
         db.session.add(new_user)
         db.session.commit()
+        bump_data_version()
+        # Открытые клиенты дополняют справочник {id: username}, иначе сообщения нового пользователя придут без имени
+        socketio.emit('user_registered', {'s': new_user.id, 'n': new_user.username})
         return redirect(url_for('login'))
     return render_template('register.html')
 
@@ -162,21 +492,26 @@ def create_group():
         if user:
             new_group.members.append(user)
     db.session.commit()
+    bump_data_version()
     return redirect(url_for('index'))
 
 @app.route('/group/<int:group_id>')
 @login_required
 def group_info(group_id):
-    group = db.session.get(Group, group_id)
+    group = get_active_group(group_id)
     if not group or current_user not in group.members:
         return "Group not found or you are not a member", 404
-    all_users = User.query.all()
-    return render_template('group_info.html', group=group, all_users=all_users)
+    # Состав группы уже загружен проверкой доступа выше, кэшируется только общий справочник
+    directory = cached_fragment('directory', build_directory)
+    member_ids = {member.id for member in group.members}
+    return render_template('group_info.html', group=group,
+                           member_items=join_items(directory['member_items'], only_ids=member_ids),
+                           member_options=member_options_html(directory, current_user.id, member_ids))
 
 @app.route('/group/<int:group_id>/edit_name', methods=['POST'])
 @login_required
 def edit_group_name(group_id):
-    group = db.session.get(Group, group_id)
+    group = get_active_group(group_id)
     if not group or current_user not in group.members:
         return "Access denied", 403
     new_name = request.form.get('group_name')
@@ -188,26 +523,45 @@ def edit_group_name(group_id):
 @app.route('/group/<int:group_id>/edit_members', methods=['POST'])
 @login_required
 def edit_group_members(group_id):
-    group = db.session.get(Group, group_id)
+    group = get_active_group(group_id)
     if not group or current_user not in group.members:
         return "Access denied", 403
     new_member_ids = {int(id) for id in request.form.getlist('members')}
     new_member_ids.add(current_user.id)
     group.members = User.query.filter(User.id.in_(new_member_ids)).all()
     db.session.commit()
+    bump_data_version()
     return redirect(url_for('group_info', group_id=group_id))
 
 @app.route('/group/<int:group_id>/delete', methods=['POST'])
 @login_required
 def delete_group(group_id):
-    group = db.session.get(Group, group_id)
+    group = get_active_group(group_id)
     if not group or current_user not in group.members:
         return "Access denied", 403
-    Message.query.filter_by(group_id=group_id).delete()
-    db.session.delete(group)
+    group.deleted_at = datetime.utcnow()
+    # Освобождаем имя, чтобы его можно было сразу занять новой группой
+    group.name = f'__deleted_{group.id}_{uuid.uuid4().hex}'
     db.session.commit()
+    socketio.close_room(f'group_{group_id}')
+    socketio.start_background_task(purge_group, group_id)
+    # Запоминаем в сессии, кто запустил удаление: после purge строки группы уже нет
+    session['purged_groups'] = (session.get('purged_groups', []) + [group_id])[-MAX_TRACKED_PURGES:]
     return redirect(url_for('index'))
 
+@app.route('/group/<int:group_id>/delete_status')
+@login_required
+def delete_group_status(group_id):
+    group = db.session.get(Group, group_id)
+    if group is None and group_id not in session.get('purged_groups', []):
+        return jsonify({"error": "Group not found"}), 404
+    if group and group.deleted_at is None:
+        return jsonify({"error": "Group is not being deleted"}), 404
+    if group and current_user not in group.members:
+        return jsonify({"error": "Access denied"}), 403
+    remaining = db.session.query(func.count(Message.id)).filter(Message.group_id == group_id).scalar()
+    return jsonify({'done': group is None, 'remaining_messages': remaining})
+
 @app.route('/history/<username>')
 @login_required
 def history(username):
@@ -231,7 +585,7 @@ def history(username):
 @app.route('/history/group/<int:group_id>')
 @login_required
 def group_history(group_id):
-    group = db.session.get(Group, group_id)
+    group = get_active_group(group_id)
     if not group or current_user not in group.members:
         return "Group not found or you are not a member", 404
     messages = Message.query.filter_by(group_id=group_id).order_by(Message.timestamp.asc()).all()
@@ -253,6 +607,7 @@ def uploaded_file(filename):
     return send_from_directory(upload_dir, filename)
 
 @app.route('/send_audio', methods=['POST'])
+@rate_limited('send_audio')
 @login_required
 def send_audio():
     audio_file = request.files.get('audio')
@@ -285,24 +640,17 @@ def send_audio():
         transcription=transcription_text
     )
 
-    message_payload = {
-        'sender': current_user.username,
-        'timestamp': timestamp.isoformat() + "Z",
-        'audio_url': audio_url,
-        'transcription': transcription_text
-    }
-    
     try:
         if group_id:
-            group = db.session.get(Group, int(group_id))
+            group = get_active_group(int(group_id))
             if not group or current_user not in group.members:
                 return jsonify({"error": "Group not found or access denied"}), 404
-            new_message.group_id = group_id
+            new_message.group_id = group.id
+            message_payload = compact_message(new_message)
             db.session.add(new_message)
             db.session.commit()
             
-            message_payload['group_id'] = group_id
-            room = f'group_{group_id}'
+            room = f'group_{group.id}'
             socketio.emit('receive_voice_message', message_payload, to=room)
         
         elif recipient_username:
@@ -310,6 +658,7 @@ def send_audio():
             if not recipient_obj:
                 return jsonify({"error": "Recipient not found"}), 404
             new_message.recipient_id = recipient_obj.id
+            message_payload = compact_message(new_message)
             db.session.add(new_message)
             db.session.commit()
 
@@ -329,6 +678,7 @@ def send_audio():
     return jsonify({"success": True}), 200
 
 @app.route('/edit_with_ai', methods=['POST'])
+@rate_limited('edit_with_ai')
 @login_required
 def edit_with_ai():
     data = request.get_json()
@@ -356,7 +706,9 @@ def edit_with_ai():
         else: # 'generate'
             prompt = original_text
 
+        # SDK провайдеров тяжелые (grpc, protobuf, pydantic), поэтому импортируются при первом вызове
         if model_choice == 'gemini':
+            import google.generativeai as genai
             api_key = os.environ.get("GEMINI_API_KEY")
             if not api_key: raise ValueError("GEMINI_API_KEY environment variable not set")
             genai.configure(api_key=api_key)
@@ -373,6 +725,7 @@ def edit_with_ai():
                 edited_text = "[Ответ был заблокирован из-за настроек безопасности]"
 
         else: # deepseek
+            from openai import OpenAI
             api_key = os.environ.get("DEEPSEEK_API_KEY")
             if not api_key: raise ValueError("DEEPSEEK_API_KEY environment variable not set")
             client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com/v1")
@@ -393,6 +746,7 @@ def edit_with_ai():
 
 # NEW ROUTE FOR THE AI ASSISTANT
 @app.route('/chat_with_assistant', methods=['POST'])
+@rate_limited('chat_with_assistant')
 @login_required
 def chat_with_assistant():
     data = request.get_json()
@@ -402,6 +756,7 @@ def chat_with_assistant():
         return jsonify({'error': 'No prompt provided'}), 400
 
     try:
+        import google.generativeai as genai
         api_key = os.environ.get("GEMINI_API_KEY")
         if not api_key: raise ValueError("GEMINI_API_KEY is not set")
         genai.configure(api_key=api_key)
@@ -415,19 +770,26 @@ def chat_with_assistant():
         print(f"Error calling Gemini Assistant API: {e}")
         return jsonify({'error': 'AI Assistant service failed'}), 500
 
+@app.route('/stats/rate_limits')
+@login_required
+def rate_limit_stats():
+    return jsonify(shared_store.get_counters())
+
 # --- WEBSOCKET LOGIC ---
 @socketio.on('connect')
 @login_required
 def handle_connect():
     user_sids[current_user.username] = request.sid
-    for group in current_user.groups:
+    for group in active_groups(current_user):
         join_room(f'group_{group.id}')
     emit('update_online_users', list(user_sids.keys()), broadcast=True)
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    for event in RATE_LIMITS:
+        shared_store.forget(f'rl:{event}:c:{request.sid}')
     if current_user.is_authenticated and current_user.username in user_sids:
-        for group in current_user.groups:
+        for group in active_groups(current_user):
             leave_room(f'group_{group.id}')
         # Добавлена проверка на случай, если sid уже удален
         if user_sids.get(current_user.username) == request.sid:
@@ -435,6 +797,7 @@ def handle_disconnect():
         emit('update_online_users', list(user_sids.keys()), broadcast=True)
 
 @socketio.on('private_message')
+@rate_limited('private_message')
 @login_required
 def handle_private_message(data):
     recipient_username = data['recipient']
@@ -445,19 +808,14 @@ def handle_private_message(data):
         return
     
     new_message = Message(sender_id=current_user.id, recipient_id=recipient_obj.id, body=message_text, timestamp=timestamp)
+    message_payload = compact_message(new_message)
     db.session.add(new_message)
     db.session.commit()
     
     recipient_sid = user_sids.get(recipient_username)
-    message_payload = {
-        'sender': current_user.username,
-        'recipient': recipient_username,
-        'message': message_text,
-        'timestamp': timestamp.isoformat() + "Z"
-    }
     if recipient_sid:
         emit('receive_private_message', message_payload, to=recipient_sid)
-        emit('new_message_notification', {'sender': current_user.username}, to=recipient_sid)
+        emit('new_message_notification', {'s': current_user.id}, to=recipient_sid)
     
     sender_sid = user_sids.get(current_user.username)
     if sender_sid:
@@ -465,27 +823,22 @@ def handle_private_message(data):
 
 
 @socketio.on('group_message')
+@rate_limited('group_message')
 @login_required
 def handle_group_message(data):
-    group_id = data['group_id']
+    group_id = int(data['group_id'])
     message_text = data['message']
     timestamp = datetime.utcnow()
-    group = db.session.get(Group, int(group_id))
+    group = get_active_group(group_id)
     if not group or current_user not in group.members:
         return
     new_message = Message(sender_id=current_user.id, group_id=group_id, body=message_text, timestamp=timestamp)
+    message_payload = compact_message(new_message)
     db.session.add(new_message)
     db.session.commit()
-    message_payload = {
-        'sender': current_user.username,
-        'message': message_text,
-        'timestamp': timestamp.isoformat() + "Z",
-        'group_id': group_id,
-        'group_name': group.name
-    }
-    room = f'group_{group_id}'
-    emit('receive_group_message', message_payload, to=room)
-    emit('new_message_notification', {'group_id': group_id, 'group_name': group.name, 'sender': current_user.username}, to=room, skip_sid=request.sid)
+    # Одно событие на комнату: пакет кодируется один раз и рассылается всем участникам,
+    # уведомление о непрочитанном клиент выводит из этого же события
+    emit('receive_group_message', message_payload, to=f'group_{group_id}')
 
 if __name__ == '__main__':
     socketio.run(app, debug=True)
\ No newline at end of file
@@ -0,0 +1,59 @@
+"""Отчет о времени запуска воркера: разбивка импорта по пакетам и время до первого запроса.
+
+Запуск: python startup_profile.py [--top N]
+Печатает JSON, который удобно сохранять и сравнивать в CI.
+"""
+import json
+import os
+import subprocess
+import sys
+from collections import Counter
+
+# Выполняется в отдельном процессе, чтобы замеры не зависели от уже загруженных модулей
+CHILD_SCRIPT = """
+import json, resource, time
+started = time.perf_counter()
+import server
+imported = time.perf_counter()
+server.app.test_client().get('/login')
+served = time.perf_counter()
+print(json.dumps({
+    'import_seconds': round(imported - started, 4),
+    'first_request_seconds': round(served - imported, 4),
+    'time_to_first_request_seconds': round(served - started, 4),
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+"""
+
+
+def import_breakdown(stderr, top):
+    # Строки -X importtime: "import time: self [us] | cumulative | imported package".
+    # Собственное время не пересекается между модулями, поэтому его можно суммировать по корневому пакету.
+    totals = Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+        totals[name.strip().split('.')[0]] += int(self_us)
+    return {package: round(us / 1e6, 4) for package, us in totals.most_common(top)}
+
+
+def main():
+    top = int(sys.argv[sys.argv.index('--top') + 1]) if '--top' in sys.argv else 15
+    root = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD_SCRIPT],
+        cwd=root, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        sys.exit(result.returncode)
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['imports'] = import_breakdown(result.stderr, top)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,14 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // Получаем имя пользователя из data-атрибута тега body
     const username = document.body.dataset.username;
+    const userId = Number(document.body.dataset.userId);
 
     let currentChat = { type: null, id: null, name: null };
     const initialData = document.getElementById('initial-data');
     let unreadCounts = JSON.parse(initialData.dataset.unreadCounts);
+    // Справочник {id: username} для разворачивания компактных сокет-сообщений
+    const userNames = JSON.parse(initialData.dataset.userNames);
+    userNames[userId] = username;
 
     function initializeUnreadCounts() {
         for (const key in unreadCounts) {
@@ -29,6 +33,29 @@ document.addEventListener('DOMContentLoaded', () => {
 
     initializeUnreadCounts();
 
+    function incrementUnread(countKey, notifId) {
+        unreadCounts[countKey] = (unreadCounts[countKey] || 0) + 1;
+        const notifIndicator = document.getElementById(notifId);
+        if (notifIndicator) {
+            notifIndicator.textContent = unreadCounts[countKey];
+            notifIndicator.classList.add('visible');
+        }
+    }
+
+    // Компактная схема: s - отправитель, r - получатель, g - группа, m - текст, t - время (мс), a - аудио, x - транскрипция
+    function expandMessage(payload) {
+        const data = {
+            sender: userNames[payload.s] || String(payload.s),
+            message: payload.m,
+            timestamp: payload.t,
+            audio_url: payload.a,
+            transcription: payload.x
+        };
+        if (payload.r !== undefined) data.recipient = userNames[payload.r];
+        if (payload.g !== undefined) data.group_id = payload.g;
+        return data;
+    }
+
     function appendMessage(data) {
         const item = document.createElement('li');
     
@@ -128,17 +155,22 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    socket.on('receive_private_message', function(data) {
+    socket.on('receive_private_message', function(payload) {
+        const data = expandMessage(payload);
         if (currentChat.type === 'user' && (data.sender === currentChat.name || (data.sender === username && data.recipient === currentChat.name))) {
             appendMessage(data);
         }
     });
-    socket.on('receive_group_message', function(data) {
+    socket.on('receive_group_message', function(payload) {
+        const data = expandMessage(payload);
         if (currentChat.type === 'group' && data.group_id == currentChat.id) {
             appendMessage(data);
+        } else if (data.sender !== username) {
+            incrementUnread(`group_${data.group_id}`, `notif-group-${data.group_id}`);
         }
     });
-    socket.on('receive_voice_message', function(data) {
+    socket.on('receive_voice_message', function(payload) {
+        const data = expandMessage(payload);
         const isGroupChat = data.hasOwnProperty('group_id');
         if ((isGroupChat && currentChat.type === 'group' && data.group_id == currentChat.id) || 
             (!isGroupChat && currentChat.type === 'user' && (data.sender === currentChat.name || data.sender === username))) {
@@ -151,23 +183,16 @@ document.addEventListener('DOMContentLoaded', () => {
             if (indicator) indicator.classList.toggle('online', online_users.includes(li.dataset.name));
         });
     });
-    socket.on('new_message_notification', function(data) {
-        if (data.sender && (currentChat.type !== 'user' || data.sender !== currentChat.name)) {
-            const countKey = data.sender;
-            unreadCounts[countKey] = (unreadCounts[countKey] || 0) + 1;
-            const notifIndicator = document.getElementById(`notif-${countKey}`);
-            if (notifIndicator) {
-                notifIndicator.textContent = unreadCounts[countKey];
-                notifIndicator.classList.add('visible');
-            }
-        } else if (data.group_id && (currentChat.type !== 'group' || data.group_id != currentChat.id)) {
-            const countKey = `group_${data.group_id}`;
-            unreadCounts[countKey] = (unreadCounts[countKey] || 0) + 1;
-            const notifIndicator = document.getElementById(`notif-group-${data.group_id}`);
-            if (notifIndicator) {
-                notifIndicator.textContent = unreadCounts[countKey];
-                notifIndicator.classList.add('visible');
-            }
+    socket.on('user_registered', function(payload) {
+        userNames[payload.s] = payload.n;
+    });
+    socket.on('rate_limited', function(payload) {
+        console.warn(`Слишком много запросов (${payload.e}), сообщение не отправлено`);
+    });
+    socket.on('new_message_notification', function(payload) {
+        const sender = userNames[payload.s];
+        if (sender && (currentChat.type !== 'user' || sender !== currentChat.name)) {
+            incrementUnread(sender, `notif-${sender}`);
         }
     });
 